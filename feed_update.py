@@ -1,8 +1,12 @@
 import argparse
+import hashlib
+import itertools
 import json
 import logging
-import re
+import sqlite3
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 import tweepy
 
@@ -12,33 +16,168 @@ logging.basicConfig(
     level=logging.INFO,
     datefmt='%Y-%m-%d %H:%M:%S')
 
-def get_OAuth_access(twitter_keys):
-    """Generates the links you need to follow to setup OAuth
+# How long cached follows and list members are trusted before refetching.
+CACHE_MAX_AGE = 6 * 60 * 60
+# How long a list synced to unchanged ids is trusted before its members are
+# fully re-read, to repair changes made outside this script.
+RECONCILE_MAX_AGE = 7 * 24 * 60 * 60
+
+def _chunked(input_list, chunk_length):
+    """Lazily yields successive lists of at most chunk_length items.
+    """
+    it = iter(input_list)
+    return iter(lambda: list(itertools.islice(it, chunk_length)), [])
+
+
+def _checksum(ids):
+    """Order independent digest of a collection of twitter ids.
     """
-    auth = tweepy.OAuthHandler(twitter_keys["api_key"], twitter_keys["api_secret_key"])
+    return hashlib.blake2b(
+        b"".join(user_id.to_bytes(8, 'little') for user_id in sorted(ids)),
+        digest_size=16).hexdigest()
+
+
+def _positive_float(value):
+    value = float(value)
+    if value <= 0:
+        raise argparse.ArgumentTypeError(f"must be greater than 0, got {value}")
+    return value
+
+
+class IdCache():
+    """Local SQLite cache of follows and list members, so runs close together
+    don't have to page through the whole API again.
+    """
+
+    def __init__(self, path, max_age=CACHE_MAX_AGE, refresh=False,
+                 reconcile_max_age=RECONCILE_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self.reconcile_max_age = reconcile_max_age
+        # When refreshing, nothing cached is trusted but fetches still get
+        # written back for the next run.
+        self.refresh = refresh
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS follows "
+                "(user_id INTEGER PRIMARY KEY, fetched_at INTEGER)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS list_members "
+                "(list_id INTEGER, user_id INTEGER, fetched_at INTEGER, "
+                "PRIMARY KEY (list_id, user_id))")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS list_checksums "
+                "(list_id INTEGER PRIMARY KEY, checksum TEXT, synced_at INTEGER)")
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(list_checksums)")}
+            if "synced_at" not in columns:
+                conn.execute("ALTER TABLE list_checksums ADD COLUMN synced_at INTEGER")
+            # When each set of ids was last fully fetched from twitter. Kept
+            # apart from the rows so an empty fetch is still cached, and so
+            # applying a pushed diff doesn't make an old fetch look fresh.
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS fetches "
+                "(name TEXT PRIMARY KEY, fetched_at INTEGER)")
+
+
+    @contextmanager
+    def _connect(self):
+        # A short lived connection per call keeps the cache usable from any thread.
+        conn = sqlite3.connect(self.path)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+
+    def _load(self, name, query, params=()):
+        """Returns the cached ids, or None if they were never fetched or the
+        last full fetch is stale.
+        """
+        if self.refresh:
+            return None
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT fetched_at FROM fetches WHERE name = ?", (name,)).fetchone()
+            if row is None or time.time() - row[0] > self.max_age:
+                return None
+            return {user_id for user_id, in conn.execute(query, params)}
+
+
+    def _set_fetched(self, conn, name, now):
+        conn.execute("INSERT OR REPLACE INTO fetches VALUES (?, ?)", (name, now))
+
+
+    def get_follows(self):
+        return self._load("follows", "SELECT user_id FROM follows")
 
-    try:
-        redirect_url = auth.get_authorization_url()
-    except tweepy.TweepyException:
-        print('Error, failed to get request token')
 
-    print(redirect_url)
+    def set_follows(self, follows_ids):
+        now = int(time.time())
+        with self._connect() as conn:
+            conn.execute("DELETE FROM follows")
+            conn.executemany(
+                "INSERT OR REPLACE INTO follows VALUES (?, ?)",
+                ((user_id, now) for user_id in follows_ids))
+            self._set_fetched(conn, "follows", now)
 
-    # Example w/o callback (desktop)
-    verifier = input('Verifier:')
 
-    try:
-        auth.get_access_token(verifier)
-    except tweepy.TweepyException:
-        print('Error! Failed to get access token.')
+    def get_list_members(self, list_id):
+        return self._load(
+            f"list_members:{list_id}",
+            "SELECT user_id FROM list_members WHERE list_id = ?", (list_id,))
 
-    print(auth.access_token)
-    print(auth.access_token_secret)
+
+    def set_list_members(self, list_id, member_ids):
+        now = int(time.time())
+        with self._connect() as conn:
+            conn.execute("DELETE FROM list_members WHERE list_id = ?", (list_id,))
+            conn.executemany(
+                "INSERT OR REPLACE INTO list_members VALUES (?, ?, ?)",
+                ((list_id, user_id, now) for user_id in member_ids))
+            self._set_fetched(conn, f"list_members:{list_id}", now)
+
+
+    def get_checksum(self, list_id):
+        """Returns the checksum of the ids the list was last synced to, or None
+        if the list is due a full reconcile.
+        """
+        if self.refresh:
+            return None
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT checksum, synced_at FROM list_checksums WHERE list_id = ?",
+                (list_id,)).fetchone()
+        if row is None or row[1] is None or time.time() - row[1] > self.reconcile_max_age:
+            return None
+        return row[0]
+
+
+    def set_checksum(self, list_id, checksum):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO list_checksums VALUES (?, ?, ?)",
+                (list_id, checksum, int(time.time())))
+
+
+    def update_list_members(self, list_id, to_add, to_remove):
+        """Applies a diff that was just pushed to twitter to the cached list.
+        Doesn't count as a fetch, so the list is still re-read once the last
+        full fetch goes stale.
+        """
+        now = int(time.time())
+        with self._connect() as conn:
+            conn.executemany(
+                "DELETE FROM list_members WHERE list_id = ? AND user_id = ?",
+                ((list_id, user_id) for user_id in to_remove))
+            conn.executemany(
+                "INSERT OR REPLACE INTO list_members VALUES (?, ?, ?)",
+                ((list_id, user_id, now) for user_id in to_add))
 
 
 class ListUpdater():
 
-    def __init__(self, twitter_keys_file_name, screen_name):
+    def __init__(self, twitter_keys_file_name, screen_name, cache=None):
         with open(twitter_keys_file_name, encoding='utf-8', errors='ignore') as json_data:
             self.twitter_keys = json.load(json_data)
 
@@ -48,6 +187,8 @@ class ListUpdater():
 
         self.screen_name = screen_name
         self.follows = None
+        self.mutuals = None
+        self.cache = cache
 
 
     def create_list(self):
@@ -65,10 +206,26 @@ class ListUpdater():
 
 
     def get_follows(self, screen_name):
-        follows_ids = []
-        for user in tweepy.Cursor(self.api.get_friends, screen_name=screen_name).items():
-            follows_ids.append(user.id)
+        if self.cache:
+            cached_ids = self.cache.get_follows()
+            if cached_ids is not None:
+                self.follows = cached_ids
+                return
+
+        follows_ids = set(tweepy.Cursor(self.api.get_friend_ids, screen_name=screen_name, count=5000).items())
         self.follows = follows_ids
+        if self.cache:
+            self.cache.set_follows(follows_ids)
+
+
+    def _ensure_follows(self):
+        if self.follows is None:
+            self.get_follows(self.screen_name)
+
+
+    def _ensure_mutuals(self):
+        if self.mutuals is None:
+            self.mutuals = self.get_mutuals()
 
 
     def get_current_list(self, list_id):
@@ -78,132 +235,175 @@ class ListUpdater():
             list_id (int): twitter ID of the list.
 
         Returns:
-            [int]: List of twitter ids in the list.
+            {int}: Set of twitter ids in the list.
         """
-        current_list_ids = []
-        for member in tweepy.Cursor(self.api.get_list_members, list_id=list_id).items():
-            current_list_ids.append(member.id)
-        logging.info(f"current_list_ids: {current_list_ids}")
+        if self.cache:
+            cached_ids = self.cache.get_list_members(list_id)
+            if cached_ids is not None:
+                logging.info("current_list_ids (cached) count=%d", len(cached_ids))
+                logging.debug("current_list_ids (cached): %s", cached_ids)
+                return cached_ids
+
+        current_list_ids = {
+            member.id for member in tweepy.Cursor(
+                self.api.get_list_members, list_id=list_id, count=5000, skip_status=True).items()}
+        logging.info("current_list_ids count=%d", len(current_list_ids))
+        logging.debug("current_list_ids: %s", current_list_ids)
+        if self.cache:
+            self.cache.set_list_members(list_id, current_list_ids)
         return current_list_ids
 
 
-    def find_new_follows(self, current_list_ids, follows_ids):
-        new_follows = [id for id in follows_ids if id not in current_list_ids]
-        return new_follows
-
-
-    def find_old_follows(self, current_list_ids, follows_ids):
-        old_follows = [id for id in current_list_ids if id not in follows_ids]
-        return old_follows
-
-
     def find_diff(self, follows_ids, current_list_ids):
-        to_add = self.find_new_follows(current_list_ids, follows_ids)
-        to_remove = self.find_old_follows(current_list_ids, follows_ids)
-        return to_add, to_remove
-
-
-    # I wonder if there is a better way of doing this... whatever this works.
-    def split_list(self, input_list, chunk_length):
-        num_slices = len(input_list) // chunk_length
-        if len(input_list) % chunk_length != 0:
-            num_slices += 1
+        """Returns the ids to add to and remove from the list.
 
-        split_list = []
-        for i in range(num_slices):
-            new_array = input_list[i*chunk_length:(i+1)*chunk_length]
-            split_list.append(new_array)
-        return split_list
+        Both arguments are expected to be sets.
+        """
+        to_add = list(follows_ids - current_list_ids)
+        to_remove = list(current_list_ids - follows_ids)
+        return to_add, to_remove
 
 
     def update_list(self, list_id, to_add, to_remove):
-        chunked_ids_to_add = self.split_list(to_add, 100)
-        chunked_ids_to_remove = self.split_list(to_remove, 100)
+        if not to_add and not to_remove:
+            logging.info("List %s already in sync", list_id)
+            return
+
+        # Push the chunks concurrently, but only a few at a time to stay well
+        # under the list members write rate limit. All removes land before any
+        # adds so the adds can't run into the list size cap.
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            for push, ids in ((self.api.remove_list_members, to_remove),
+                              (self.api.add_list_members, to_add)):
+                futures = [
+                    executor.submit(push, list_id=list_id, user_id=ids_list)
+                    for ids_list in _chunked(ids, 100)]
+                for future in futures:
+                    future.result()
+        if self.cache:
+            self.cache.update_list_members(list_id, to_add, to_remove)
+
+
+    def _sync_list(self, list_id, target_ids, label):
+        # If the list was last synced to exactly these ids there is nothing to
+        # do, and the list members don't need to be fetched at all.
+        checksum = _checksum(target_ids) if self.cache else None
+        if checksum and self.cache.get_checksum(list_id) == checksum:
+            logging.info("No %s changes since list %s was last synced", label, list_id)
+            return
 
-        for ids_list in chunked_ids_to_add:
-            self.api.add_list_members(list_id=list_id, user_id=ids_list)
-        for ids_list in chunked_ids_to_remove:
-            self.api.remove_list_members(list_id=list_id, user_id=ids_list)
+        current_list_ids = self.get_current_list(list_id)
+        to_add, to_remove = self.find_diff(target_ids, current_list_ids)
+        logging.info("New %s found, to add count=%d", label, len(to_add))
+        logging.debug("New %s found, to add: %s", label, to_add)
+        logging.info("Old %s found, to remove count=%d", label, len(to_remove))
+        logging.debug("Old %s found, to remove: %s", label, to_remove)
+        self.update_list(list_id, to_add, to_remove)
+        if checksum:
+            self.cache.set_checksum(list_id, checksum)
 
 
     def update_following(self, list_id=1400695918391746560):
-        if not self.follows:
-            self.get_follows(self.screen_name)
-        current_list_ids = self.get_current_list(list_id)
-        to_add, to_remove = self.find_diff(self.follows, current_list_ids)
-        logging.info(f"New followers found, to add: {to_add}")
-        logging.info(f"Old followers found, to remove: {to_remove}")
-        self.update_list(list_id, to_add, to_remove)
+        self._ensure_follows()
+        self._sync_list(list_id, self.follows, "followers")
 
 
     def get_followers(self):
         """
-        Returns a list of twitter ids of users who follow the user.
+        Yields the twitter ids of users who follow the user, page by page.
+        """
+        return tweepy.Cursor(self.api.get_follower_ids, screen_name=self.screen_name, count=5000).items()
+
+
+    def get_mutuals(self):
+        """
+        Returns a set of twitter ids of users the user follows who follow them back.
         """
-        followers = []
-        for user in tweepy.Cursor(self.api.get_followers, screen_name=self.screen_name).items():
-            followers.append(user.id)
-        return followers
-    
+        # Filter the followers against the follows while paging so the full
+        # set of followers is never held in memory.
+        self._ensure_follows()
+        return {user_id for user_id in self.get_followers() if user_id in self.follows}
+
 
     def get_names_and_handles(self, twitter_ids):
         """returns the names and handles of the users given their twitter ids.
         """
-        return_value = []
-        users = self.api.lookup_users(user_id=twitter_ids)
-        for user in users:
-            return_value.append((user.name, user.screen_name))
-        return return_value
+        # users/lookup takes at most 100 ids per request.
+        return [
+            (user.name, user.screen_name)
+            for ids_list in _chunked(twitter_ids, 100)
+            for user in self.api.lookup_users(user_id=ids_list)]
 
 
     def update_mutuals(self, list_id=1437506909926354944):
-        mutuals = []
-        if not self.follows:
-            self.get_follows(self.screen_name)
-        followers = self.get_followers()
-        for follow in self.follows:
-            if follow in followers:
-                mutuals.append(follow) 
-
-        current_list_ids = self.get_current_list(list_id)
-        to_add, to_remove = self.find_diff(mutuals, current_list_ids)
-        logging.info(f"New mutuals found, to add: {to_add}")
-        logging.info(f"Old mutuals found, to remove: {to_remove}")
-
-        # names, handles = self.get_names_and_handles(to_add)
-        # for name, handle in names, handles:
-        #     logging.info(f"New mutuals found: {name} @{handle}")
-
-        # names, handles = self.get_names_and_handles(to_remove)
-        # for name, handle in names, handles:
-        #     logging.info(f"Old mutuals removed: {name} @{handle}")
-
-        self.update_list(list_id, to_add, to_remove)
+        self._ensure_mutuals()
+        self._sync_list(list_id, self.mutuals, "mutuals")
 
 
     def update(self):
-        self.update_following()
+        # Follows and mutuals are only memoized for a single pass, since the
+        # same updater is reused when running on an interval.
+        self.follows = None
+        self.mutuals = None
+        self._ensure_follows()
+        # Page through the followers for the mutuals while the following list
+        # is synced; they are network bound and hit separate rate limit buckets.
+        with ThreadPoolExecutor() as executor:
+            mutuals_future = executor.submit(self._ensure_mutuals)
+            self.update_following()
+            mutuals_future.result()
         self.update_mutuals()
 
 
 def main():
-    logging.info("Starting update")
-
     parser = argparse.ArgumentParser(
         description='Auto update a twitter list')
     parser.add_argument(
         'keys',
         default="/Users/akuna/preps/twitter_auto_scripts/twitter_keys.json",
         help='path to the twitter keys json file')
+    parser.add_argument(
+        '--cache',
+        default='feed_update.sqlite',
+        help='path to the sqlite cache of follows and list members')
+    parser.add_argument(
+        '--refresh',
+        action='store_true',
+        help='ignore cached ids and checksums and do a full fetch from twitter '
+             '(with --interval, only on the first pass)')
+    parser.add_argument(
+        '--interval',
+        type=_positive_float,
+        help='keep running and update every INTERVAL minutes, reusing the api session')
     args = parser.parse_args()
 
     screen_name = "awlego"
     # lists_to_update = [("Awlego's Feed (Auto)", 1400695918391746560), ("Awlego's Mutuals", 1437506909926354944)]
 
-    list_updater = ListUpdater(args.keys, screen_name)
-    list_updater.update()
-
-    logging.info("Finished update")
+    max_age = CACHE_MAX_AGE
+    if args.interval:
+        # The session is already warm, so don't let cached follows hide
+        # changes for longer than one interval.
+        max_age = min(max_age, args.interval * 60)
+    cache = IdCache(args.cache, max_age=max_age, refresh=args.refresh)
+    list_updater = ListUpdater(args.keys, screen_name, cache)
+    while True:
+        logging.info("Starting update")
+        try:
+            list_updater.update()
+        except Exception:
+            if not args.interval:
+                raise
+            # Keep running, like a failed cron run that the next one retries.
+            logging.exception("Update failed, retrying in %s minutes", args.interval)
+        else:
+            logging.info("Finished update")
+            # --refresh only forces the first successful pass; later passes
+            # use the cache again.
+            cache.refresh = False
+        if not args.interval:
+            break
+        time.sleep(args.interval * 60)
 
 
 if __name__ == "__main__":
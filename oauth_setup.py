@@ -0,0 +1,44 @@
+import argparse
+import json
+
+import tweepy
+
+def get_OAuth_access(twitter_keys):
+    """Generates the links you need to follow to setup OAuth
+    """
+    auth = tweepy.OAuthHandler(twitter_keys["api_key"], twitter_keys["api_secret_key"])
+
+    try:
+        redirect_url = auth.get_authorization_url()
+    except tweepy.TweepyException:
+        print('Error, failed to get request token')
+
+    print(redirect_url)
+
+    # Example w/o callback (desktop)
+    verifier = input('Verifier:')
+
+    try:
+        auth.get_access_token(verifier)
+    except tweepy.TweepyException:
+        print('Error! Failed to get access token.')
+
+    print(auth.access_token)
+    print(auth.access_token_secret)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='One time setup of the OAuth access token and secret')
+    parser.add_argument(
+        'keys',
+        help='path to the twitter keys json file with your api_key and api_secret_key')
+    args = parser.parse_args()
+
+    with open(args.keys, encoding='utf-8', errors='ignore') as json_data:
+        twitter_keys = json.load(json_data)
+    get_OAuth_access(twitter_keys)
+
+
+if __name__ == "__main__":
+    main()